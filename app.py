@@ -14,10 +14,12 @@ Order Completion Rate Analysis System
 
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime, date
-import json
+import orjson
 import os
 from io import BytesIO
+from pathlib import Path
 
 # ============================================================================
 # 页面配置 - 设置中文字体和页面属性
@@ -34,9 +36,12 @@ st.set_page_config(
     }
 )
 
-# 设置中文字体
-st.markdown("""
+# ============================================================================
+# 页面样式 - 中文字体和自定义CSS（合并为一个样式块，每次运行只注入一次）
+# ============================================================================
+APP_CSS = """
 <style>
+    /* 中文字体 */
     @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+SC:wght@400;700&display=swap');
     
     html, body, [class*="css"] {
@@ -66,14 +71,7 @@ st.markdown("""
     .stSuccess, .stError, .stWarning, .stInfo {
         font-family: 'Noto Sans SC', 'PingFang SC', 'Microsoft YaHei', sans-serif;
     }
-</style>
-""", unsafe_allow_html=True)
-
-# ============================================================================
-# 自定义CSS样式
-# ============================================================================
-st.markdown("""
-<style>
+    
     /* 标题样式 */
     .main-title {
         font-size: 28px;
@@ -173,27 +171,26 @@ st.markdown("""
         line-height: 1.8;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+st.markdown(APP_CSS, unsafe_allow_html=True)
 
 # ============================================================================
 # 数据存储路径
 # ============================================================================
 DATA_DIR = os.path.expanduser("~/order_analysis_data")
 os.makedirs(DATA_DIR, exist_ok=True)
-HISTORY_FILE = os.path.join(DATA_DIR, "history.json")
+HISTORY_FILE = os.path.join(DATA_DIR, "history.jsonl")
+LEGACY_HISTORY_FILE = os.path.join(DATA_DIR, "history.json")  # 旧版本的历史记录文件
+
+# 历史记录序列化选项（统计值可能是numpy数值类型，直接序列化无需转换）
+HISTORY_JSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
 
 # ============================================================================
 # 初始化会话状态
 # ============================================================================
 def init_session_state():
-    """初始化会话状态"""
-    if 'history' not in st.session_state:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                st.session_state.history = json.load(f)
-        else:
-            st.session_state.history = []
-    
+    """初始化会话状态（历史记录在首次使用时才加载，见get_history）"""
     if 'plan_df' not in st.session_state:
         st.session_state.plan_df = None
     
@@ -209,20 +206,139 @@ def init_session_state():
     
     if 'filter_applied' not in st.session_state:
         st.session_state.filter_applied = False
+    
+    # 城市名称是否已清理（每次上传后只需清理一次）
+    if 'cities_normalized' not in st.session_state:
+        st.session_state.cities_normalized = False
+    
+    # 实际完工数据是否已按完工时间排序（开始分析时排序，重新上传后清空）
+    if 'actual_sorted' not in st.session_state:
+        st.session_state.actual_sorted = False
+    
+    # 计划表格中的省份列表、全部城市列表和各省份下的城市列表
+    # （数据替换时清空，下次使用时重新计算）
+    if 'province_cities' not in st.session_state:
+        st.session_state.province_cities = None
+    if 'plan_provinces' not in st.session_state:
+        st.session_state.plan_provinces = None
+    if 'plan_all_cities' not in st.session_state:
+        st.session_state.plan_all_cities = None
+    
+    # 当前分析结果对应的筛选条件和数据（数据被替换时清空）
+    if 'analysis_signature' not in st.session_state:
+        st.session_state.analysis_signature = None
+
+def get_history():
+    """获取历史记录（首次使用时才从文件加载）"""
+    if 'history' not in st.session_state:
+        st.session_state.history = load_history()
+        # 旧版本的history.json迁移为按行存储的history.jsonl
+        if st.session_state.history and not os.path.exists(HISTORY_FILE):
+            save_history()
+    return st.session_state.history
+
+def load_history():
+    """
+    从文件加载历史记录
+    
+    文件中每行一条记录，按保存先后追加；内存中最新的记录在前
+    """
+    if os.path.exists(HISTORY_FILE):
+        lines = Path(HISTORY_FILE).read_bytes().splitlines()
+        history = [orjson.loads(line) for line in lines if line.strip()]
+        history.reverse()
+        return history
+    
+    if os.path.exists(LEGACY_HISTORY_FILE):
+        return orjson.loads(Path(LEGACY_HISTORY_FILE).read_bytes())
+    
+    return []
 
 def save_history():
-    """保存历史记录到文件"""
-    with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-        json.dump(st.session_state.history, f, ensure_ascii=False, indent=2)
+    """重写整个历史记录文件（用于修改标题、删除记录）"""
+    Path(HISTORY_FILE).write_bytes(b''.join(
+        orjson.dumps(item, option=HISTORY_JSON_OPTIONS) + b'\n' for item in reversed(st.session_state.history)
+    ))
+
+def append_history(item):
+    """追加一条历史记录到文件末尾，无需重写已有记录"""
+    with open(HISTORY_FILE, 'ab') as f:
+        f.write(orjson.dumps(item, option=HISTORY_JSON_OPTIONS) + b'\n')
 
 # ============================================================================
 # 数据处理函数
 # ============================================================================
+# 上传表格中会用到的列（包含重命名前的列名），其余列读取时直接跳过
+# 计划表格中的"预约完工时间"不再使用，读取时即被排除
+PLAN_COLS = ('工单号', '省', '市', '省份', '城市', '来单时间', '工单创建时间')
+ACTUAL_COLS = ('工单号', '省', '市', '省份', '城市', '完工时间',
+               '预约开始时间', '预约结束时间', '上门签到时间', '工人姓名', '旧机信息')
+
+@st.cache_data(show_spinner=False, max_entries=8)
+def read_excel_file(raw, columns):
+    """
+    读取上传的XLSX文件内容（优先使用calamine引擎，不可用时回退到openpyxl）
+    
+    - 只读取columns中的列，表格中不存在的列会被忽略
+    - 按文件内容缓存，页面重新运行时无需重复解析同一个文件
+    """
+    usecols = lambda col: col in columns
+    try:
+        return pd.read_excel(BytesIO(raw), engine='calamine', usecols=usecols)
+    except (ImportError, ValueError):
+        # 未安装python-calamine或pandas版本过低
+        return pd.read_excel(BytesIO(raw), engine='openpyxl', usecols=usecols)
+
+# 需要转换为datetime格式的时间列
+DATETIME_COLS = ['工单创建时间', '完工时间', '预约开始时间', '预约结束时间', '上门签到时间']
+
+def parse_datetime_columns(df):
+    """将时间列转换为datetime格式（已是datetime类型的列直接跳过）"""
+    for col in DATETIME_COLS:
+        if col in df.columns and not pd.api.types.is_datetime64_any_dtype(df[col]):
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+    return df
+
+def strip_city_suffix(cities):
+    """去掉城市名称末尾的"市"字（分类列只处理类别本身）"""
+    if isinstance(cities.dtype, pd.CategoricalDtype):
+        categories = cities.cat.categories.str.removesuffix('市')
+        if categories.is_unique:
+            return cities.cat.rename_categories(categories)
+        return cities.astype(object).str.removesuffix('市').astype('category')
+    return cities.str.removesuffix('市')
+
+def encode_region_columns(df):
+    """将省份、城市列转换为分类类型，加速筛选和分组"""
+    for col in ('省份', '城市'):
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    return df
+
+def hash_dataframe(df):
+    """
+    按完整内容计算DataFrame的缓存键
+    
+    Streamlit默认对5万行以上的表格只按形状、类型和抽样行计算哈希，
+    修改少量单元格后重新上传可能命中旧的缓存结果，这里对所有行计算哈希
+    """
+    return (
+        tuple(df.columns),
+        tuple(str(dtype) for dtype in df.dtypes),
+        pd.util.hash_pandas_object(df, index=True).values.tobytes()
+    )
+
+# 以DataFrame为参数的缓存函数统一使用完整内容哈希
+DATAFRAME_HASH_FUNCS = {pd.DataFrame: hash_dataframe}
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs=DATAFRAME_HASH_FUNCS)
 def validate_and_process_data(plan_df, actual_df):
     """
     验证和处理数据
     - 重命名列名
-    - 删除不需要的列
+    - 清理城市名称、转换列类型
+    
+    不需要的列（如"预约完工时间"）在读取文件时已被排除，见PLAN_COLS
     """
     errors = []
     
@@ -235,16 +351,17 @@ def validate_and_process_data(plan_df, actual_df):
             '市': '城市'       # 市 → 城市
         }
         plan_df = plan_df.rename(columns=rename_map)
-        
-        # 删除不需要的列
-        cols_to_drop = ['预约完工时间']
-        existing_cols_to_drop = [col for col in cols_to_drop if col in plan_df.columns]
-        if existing_cols_to_drop:
-            plan_df = plan_df.drop(columns=existing_cols_to_drop)
+        plan_cols = set(plan_df.columns)
         
         # 清理城市名称（去掉末尾的"市"字，避免显示为"深圳市市"）
-        if '城市' in plan_df.columns:
-            plan_df.loc[:, '城市'] = plan_df['城市'].str.replace('市$', '', regex=True)
+        if '城市' in plan_cols:
+            plan_df['城市'] = strip_city_suffix(plan_df['城市'])
+        
+        # 省份、城市转换为分类类型
+        plan_df = encode_region_columns(plan_df)
+        
+        # 转换时间列（只在导入时解析一次）
+        plan_df = parse_datetime_columns(plan_df)
     
     # 处理实际完工数据
     if actual_df is not None:
@@ -254,26 +371,74 @@ def validate_and_process_data(plan_df, actual_df):
             '市': '城市'       # 市 → 城市
         }
         actual_df = actual_df.rename(columns=rename_map)
+        actual_cols = set(actual_df.columns)
         
         # 清理城市名称（去掉末尾的"市"字）
-        if '城市' in actual_df.columns:
-            actual_df.loc[:, '城市'] = actual_df['城市'].str.replace('市$', '', regex=True)
+        if '城市' in actual_cols:
+            actual_df['城市'] = strip_city_suffix(actual_df['城市'])
+        
+        # 省份、城市转换为分类类型
+        actual_df = encode_region_columns(actual_df)
+        
+        # 转换时间列（只在导入时解析一次，签到校验直接使用）
+        actual_df = parse_datetime_columns(actual_df)
+        
+        # 按完工时间排序（稳定排序，空值排在最后），签到校验按日/月筛选时可直接二分查找
+        if '完工时间' in actual_cols:
+            actual_df = actual_df.sort_values('完工时间', kind='mergesort', ignore_index=True)
         
         # 确保必要的列存在
         required_cols = ['工单号', '省份', '城市', '完工时间']
-        missing_cols = [col for col in required_cols if col not in actual_df.columns]
+        missing_cols = [col for col in required_cols if col not in actual_cols]
         if missing_cols:
             errors.append(f"实际完工表格缺少必要列：{', '.join(missing_cols)}")
         
         # 新增的列（用于签到校验）
         optional_cols = ['预约开始时间', '预约结束时间', '上门签到时间', '工人姓名', '旧机信息']
-        missing_optional = [col for col in optional_cols if col not in actual_df.columns]
+        missing_optional = [col for col in optional_cols if col not in actual_cols]
         if missing_optional:
             # 这些是可选的，签到校验功能会检查
             pass
     
     return plan_df, actual_df, errors
 
+def build_province_cities(plan_df):
+    """整理计划表格中每个省份下的城市列表（按首次出现的顺序）"""
+    if '省份' not in plan_df.columns or '城市' not in plan_df.columns:
+        return {}
+    
+    pairs = plan_df[['省份', '城市']].dropna().drop_duplicates()
+    return {
+        province: group['城市'].tolist()
+        for province, group in pairs.groupby('省份', observed=True, sort=False)
+    }
+
+def build_plan_regions(plan_df):
+    """整理计划表格中的省份列表（pd.Index）和全部城市列表（按首次出现的顺序）"""
+    provinces = pd.Index(plan_df['省份'].dropna().unique()) if '省份' in plan_df.columns else pd.Index([])
+    all_cities = list(plan_df['城市'].dropna().unique()) if '城市' in plan_df.columns else []
+    return provinces, all_cities
+
+def match_order_ids(plan_df, actual_df, keys):
+    """
+    按工单号对比计划待完工与实际完工数据
+    
+    两个表格按keys去重后做一次外连接，_merge列标记工单所在的表格：
+    - left_only：只在计划表格中
+    - right_only：只在实际表格中（改单回收）
+    - both：同时存在于两个表格（预约内完工）
+    """
+    plan_keys = plan_df[keys].dropna(subset=['工单号']).drop_duplicates()
+    actual_keys = actual_df[keys].dropna(subset=['工单号']).drop_duplicates()
+    
+    # 两个表格的工单号类型不一致时（如数字与文本）统一按object比较
+    if plan_keys['工单号'].dtype != actual_keys['工单号'].dtype:
+        plan_keys = plan_keys.astype({'工单号': object})
+        actual_keys = actual_keys.astype({'工单号': object})
+    
+    return plan_keys.merge(actual_keys, on=keys, how='outer', indicator=True)
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs=DATAFRAME_HASH_FUNCS)
 def analyze_data_by_region(plan_df, actual_df, selected_provinces=None, selected_cities=None):
     """
     按区域分析数据
@@ -281,8 +446,8 @@ def analyze_data_by_region(plan_df, actual_df, selected_provinces=None, selected
     参数：
     - plan_df: 计划待完工数据
     - actual_df: 实际完工数据
-    - selected_provinces: 选中的省份列表
-    - selected_cities: 选中的城市列表
+    - selected_provinces: 选中的省份元组
+    - selected_cities: 选中的城市元组
     
     返回：
     - 统计概览数据和区域详情表格
@@ -290,44 +455,56 @@ def analyze_data_by_region(plan_df, actual_df, selected_provinces=None, selected
     if plan_df is None or actual_df is None:
         return None
     
-    # 初始化筛选条件
+    # 初始化筛选条件（使用元组以便缓存时计算哈希）
     if selected_provinces is None:
-        selected_provinces = []
+        selected_provinces = ()
     if selected_cities is None:
-        selected_cities = []
+        selected_cities = ()
     
-    # 筛选数据
-    filtered_plan = plan_df.copy()
-    filtered_actual = actual_df.copy()
+    # 筛选数据（只保留分析所需的列，避免复制整张表格）
+    key_cols = ['工单号', '省份', '城市']
+    filtered_plan = plan_df[[col for col in key_cols if col in plan_df.columns]]
+    filtered_actual = actual_df[[col for col in key_cols if col in actual_df.columns]]
     
     # 省份筛选
-    if selected_provinces and len(selected_provinces) > 0:
+    if selected_provinces:
         filtered_plan = filtered_plan[filtered_plan['省份'].isin(selected_provinces)]
         filtered_actual = filtered_actual[filtered_actual['省份'].isin(selected_provinces)]
     
     # 城市筛选
-    if selected_cities and len(selected_cities) > 0:
+    if selected_cities:
         filtered_plan = filtered_plan[filtered_plan['城市'].isin(selected_cities)]
         filtered_actual = filtered_actual[filtered_actual['城市'].isin(selected_cities)]
     
-    # 获取工单号集合
-    plan_ids = set(filtered_plan['工单号'].dropna()) if '工单号' in filtered_plan.columns else set()
-    actual_ids = set(filtered_actual['工单号'].dropna()) if '工单号' in filtered_actual.columns else set()
+    # 对比两个表格（缺少工单号列的表格视为空表），概览和区域详情共用同一次合并结果
+    empty_ids = pd.DataFrame({'工单号': pd.Series([], dtype=object)})
+    plan_keys = filtered_plan if '工单号' in filtered_plan.columns else empty_ids
+    actual_keys = filtered_actual if '工单号' in filtered_actual.columns else empty_ids
+    by_city = '城市' in plan_keys.columns and '城市' in actual_keys.columns
+    matched = match_order_ids(plan_keys, actual_keys, ['城市', '工单号'] if by_city else ['工单号'])
+    
+    # 判断每个工单号是否存在于计划/实际表格
+    status = matched['_merge']
+    in_plan = status != 'right_only'
+    in_actual = status != 'left_only'
+    if not matched['工单号'].is_unique:
+        # 同一工单号出现在多个城市时，按工单号汇总
+        flags = pd.DataFrame({'in_plan': in_plan, 'in_actual': in_actual}).groupby(matched['工单号']).any()
+        in_plan = flags['in_plan']
+        in_actual = flags['in_actual']
     
     # 计算各类订单数量
-    total_plan = len(plan_ids)  # 计划待完工总数
-    total_actual = len(actual_ids)  # 实际完工总数
-    on_time_ids = plan_ids.intersection(actual_ids)  # 预约内完工（同时存在于两个表格）
-    modified_ids = actual_ids.difference(plan_ids)  # 改单回收（只在实际完工中存在）
+    total_plan = int(in_plan.sum())  # 计划待完工总数
+    total_actual = int(in_actual.sum())  # 实际完工总数
+    on_time_count = int((in_plan & in_actual).sum())  # 预约内完工（同时存在于两个表格）
+    modified_count = int((in_actual & ~in_plan).sum())  # 改单回收（只在实际完工中存在）
     
     # 计算完工率：新的公式（预约内完工+改单完工）/计划待完工×100%
-    on_time_count = len(on_time_ids)
-    modified_count = len(modified_ids)
     today_completed = on_time_count + modified_count  # 今日完工 = 预约内完工 + 改单回收
     completion_rate = (today_completed / total_plan * 100) if total_plan > 0 else 0
     
     # 按区域统计详细数据
-    region_stats = analyze_region_details(filtered_plan, filtered_actual)
+    region_stats = analyze_region_details(matched, filtered_plan, filtered_actual) if by_city else pd.DataFrame()
     
     return {
         'total_plan': total_plan,
@@ -339,10 +516,15 @@ def analyze_data_by_region(plan_df, actual_df, selected_provinces=None, selected
         'region_stats': region_stats
     }
 
-def analyze_region_details(plan_df, actual_df):
+def analyze_region_details(matched, plan_df, actual_df):
     """
     按城市统计详细数据
     
+    参数：
+    - matched: match_order_ids按（城市, 工单号）合并的结果
+    - plan_df: 计划待完工数据（用于获取城市所属省份）
+    - actual_df: 实际完工数据（用于获取城市所属省份）
+    
     计算逻辑：
     - 计划待完工：该城市在计划表格中的工单数
     - 预约内完工：该城市在计划+实际表格中工单号一致的订单数
@@ -353,57 +535,69 @@ def analyze_region_details(plan_df, actual_df):
         return pd.DataFrame()
     
     # 确保有省份和城市列
-    if '省份' not in plan_df.columns or '城市' not in plan_df.columns:
+    plan_cols = set(plan_df.columns)
+    if '省份' not in plan_cols or '城市' not in plan_cols:
         return pd.DataFrame()
     
-    # 获取所有城市
-    all_cities = set(plan_df['城市'].dropna().unique())
-    if '城市' in actual_df.columns:
-        all_cities.update(actual_df['城市'].dropna().unique())
-    
-    # 初始化结果列表
-    results = []
-    
-    for city in all_cities:
-        # 该城市的计划数据
-        city_plan = plan_df[plan_df['城市'] == city]
-        city_plan_ids = set(city_plan['工单号'].dropna())
-        plan_count = len(city_plan_ids)
-        
-        # 该城市的实际数据
-        city_actual = actual_df[actual_df['城市'] == city]
-        city_actual_ids = set(city_actual['工单号'].dropna())
-        
-        # 预约内完工：工单号一致
-        on_time_count = len(city_plan_ids.intersection(city_actual_ids))
-        
-        # 改单回收：工单号不一致
-        modified_count = len(city_actual_ids.difference(city_plan_ids))
-        
-        # 计算完工率：（预约内完工+改单回收）/ 计划待完工 × 100%
-        today_completed = on_time_count + modified_count
-        completion_rate = (today_completed / plan_count * 100) if plan_count > 0 else 0
-        
-        # 获取省份
-        province = city_plan['省份'].iloc[0] if len(city_plan) > 0 else \
-                   (city_actual['省份'].iloc[0] if len(city_actual) > 0 else '')
-        
-        results.append({
-            '省份': province,
-            '城市': city,
-            '计划待完工': plan_count,
-            '预约内完工': on_time_count,
-            '改单回收': modified_count,
-            '完工率': f"{completion_rate:.2f}%"
-        })
-    
-    # 创建DataFrame并按计划待完工数量降序排序
-    df = pd.DataFrame(results)
+    # 按城市统计每类工单的数量
+    status_counts = matched.groupby('城市', observed=True)['_merge'].value_counts().unstack(fill_value=0)
+    status_counts = status_counts.reindex(columns=['left_only', 'right_only', 'both'], fill_value=0)
+    
+    # 计划待完工、预约内完工（工单号一致）、改单回收（工单号不一致）
+    counts = pd.DataFrame({
+        '计划待完工': status_counts['left_only'] + status_counts['both'],
+        '预约内完工': status_counts['both'],
+        '改单回收': status_counts['right_only']
+    })
+    
+    # 获取省份（优先取计划表格中该城市第一条记录的省份）
+    province = pd.concat([
+        plan_df[['城市', '省份']].drop_duplicates('城市').astype(object),
+        actual_df[['城市', '省份']].drop_duplicates('城市').astype(object)
+    ]).dropna(subset=['城市']).drop_duplicates('城市').set_index('城市')['省份']
+    
+    # 两个表格中出现过的城市都要列出（工单号全部为空的城市统计为0）
+    counts = counts.reindex(province.index, fill_value=0)
+    
+    # 计算完工率：（预约内完工+改单回收）/ 计划待完工 × 100%
+    today_completed = counts['预约内完工'] + counts['改单回收']
+    completion_rate = (today_completed / counts['计划待完工'] * 100).where(counts['计划待完工'] > 0, 0)
+    
+    results = pd.DataFrame({
+        '省份': province.reindex(counts.index).fillna(''),
+        '城市': counts.index,
+        '计划待完工': counts['计划待完工'],
+        '预约内完工': counts['预约内完工'],
+        '改单回收': counts['改单回收'],
+        '完工率': completion_rate.map(lambda rate: f"{rate:.2f}%")
+    })
+    
+    # 按计划待完工数量降序排序
+    df = results.reset_index(drop=True)
     if not df.empty:
         df = df.sort_values('计划待完工', ascending=False)
     
     return df
 
+def slice_by_completed_time(actual_df, start, end, is_sorted=False):
+    """
+    取完工时间在[start, end)范围内的行
+    
+    - is_sorted: 数据已在validate_and_process_data中按完工时间排序（空值在最后），
+      直接用searchsorted二分查找得到切片
+    - 未排序的原始数据回退为逐行比较
+    """
+    completed_at = actual_df['完工时间']
+    if is_sorted:
+        lo = completed_at.searchsorted(start)
+        hi = completed_at.searchsorted(end)
+        return actual_df.iloc[lo:hi]
+    
+    if not pd.api.types.is_datetime64_any_dtype(completed_at):
+        completed_at = pd.to_datetime(completed_at, errors='coerce')
+    return actual_df.loc[(completed_at >= start) & (completed_at < end)]
+
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs=DATAFRAME_HASH_FUNCS)
 def analyze_checkin(actual_df):
     """
     分析签到时间是否在预约时间范围内
@@ -413,7 +607,8 @@ def analyze_checkin(actual_df):
     
     # 检查必要的列是否存在
     required_cols = ['预约开始时间', '预约结束时间', '上门签到时间']
-    missing_cols = [col for col in required_cols if col not in actual_df.columns]
+    actual_cols = set(actual_df.columns)
+    missing_cols = [col for col in required_cols if col not in actual_cols]
     if missing_cols:
         return {
             'available': False,
@@ -421,19 +616,15 @@ def analyze_checkin(actual_df):
             'message': f"数据中缺少签到校验所需的列：{', '.join(missing_cols)}"
         }
     
-    # 复制数据进行处理
-    df = actual_df.copy()
-    
-    # 转换时间列为datetime格式
-    time_cols = ['预约开始时间', '预约结束时间', '上门签到时间']
-    for col in time_cols:
-        if col in df.columns:
-            df.loc[:, col] = pd.to_datetime(df[col], errors='coerce')
+    # 时间列在导入时已转换的直接使用，否则复制一份再转换（不修改传入的数据）
+    df = actual_df
+    if not all(pd.api.types.is_datetime64_any_dtype(df[col]) for col in required_cols):
+        df = parse_datetime_columns(df.copy())
     
     # 过滤掉上门签到时间为空的记录
     valid_df = df[df['上门签到时间'].notna()].copy()
     
-    if len(valid_df) == 0:
+    if valid_df.empty:
         return {
             'available': True,
             'valid_count': 0,
@@ -444,18 +635,20 @@ def analyze_checkin(actual_df):
             'message': '所有记录的上门签到时间均为空，无法进行校验'
         }
     
-    # 判断签到时间是否在预约时间范围内
-    valid_df['签到状态'] = valid_df.apply(
-        lambda row: '有效' if pd.notna(row['预约开始时间']) and pd.notna(row['预约结束时间']) 
-        and row['预约开始时间'] <= row['上门签到时间'] <= row['预约结束时间'] 
-        else '无效', axis=1
-    )
+    # 判断签到时间是否在预约时间范围内（整列向量化比较）
+    # NaT与任何时间比较结果均为False，预约时间为空的记录自然判为无效，无需单独判断空值
+    start = valid_df['预约开始时间'].values
+    end = valid_df['预约结束时间'].values
+    checkin = valid_df['上门签到时间'].values
+    mask = checkin >= start
+    mask &= checkin <= end
+    valid_df['签到状态'] = np.where(mask, '有效', '无效')
     
     # 统计
-    valid_count = len(valid_df[valid_df['签到状态'] == '有效'])
-    invalid_count = len(valid_df[valid_df['签到状态'] == '无效'])
+    valid_count = int(mask.sum())
+    invalid_count = mask.size - valid_count
     excluded_count = len(df) - len(valid_df)
-    compliance_rate = (valid_count / len(valid_df) * 100) if len(valid_df) > 0 else 0
+    compliance_rate = valid_count / mask.size * 100
     
     return {
         'available': True,
@@ -467,6 +660,18 @@ def analyze_checkin(actual_df):
         'message': None
     }
 
+@st.cache_data(show_spinner=False, max_entries=8, hash_funcs=DATAFRAME_HASH_FUNCS)
+def to_xlsx_bytes(df, sheet_name):
+    """
+    将DataFrame导出为XLSX文件内容
+    
+    - 按表格完整内容缓存，页面重新运行时无需重复生成同一份Excel
+    """
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        df.to_excel(writer, index=False, sheet_name=sheet_name)
+    return output.getvalue()
+
 # ============================================================================
 # 页面组件
 # ============================================================================
@@ -551,8 +756,13 @@ def render_data_import_page():
         
         if plan_file:
             try:
-                df = pd.read_excel(plan_file)
+                df = read_excel_file(plan_file.getvalue(), PLAN_COLS)
                 st.session_state.plan_df = df
+                st.session_state.cities_normalized = False
+                st.session_state.analysis_signature = None
+                st.session_state.province_cities = None
+                st.session_state.plan_provinces = None
+                st.session_state.plan_all_cities = None
                 # 重置筛选状态
                 st.session_state.selected_provinces = []
                 st.session_state.selected_cities = []
@@ -598,8 +808,15 @@ def render_data_import_page():
         
         if actual_file:
             try:
-                df = pd.read_excel(actual_file)
+                df = read_excel_file(actual_file.getvalue(), ACTUAL_COLS)
                 st.session_state.actual_df = df
+                st.session_state.actual_sorted = False
+                st.session_state.cities_normalized = False
+                st.session_state.analysis_signature = None
+                # 城市名称会重新清理，计划表格的省市列表需要重新计算
+                st.session_state.province_cities = None
+                st.session_state.plan_provinces = None
+                st.session_state.plan_all_cities = None
                 # 重置筛选状态
                 st.session_state.selected_provinces = []
                 st.session_state.selected_cities = []
@@ -621,23 +838,26 @@ def render_data_import_page():
         if st.session_state.plan_df is not None and st.session_state.actual_df is not None:
             # 验证和处理数据
             plan_df, actual_df, errors = validate_and_process_data(
-                st.session_state.plan_df.copy(),
-                st.session_state.actual_df.copy()
+                st.session_state.plan_df,
+                st.session_state.actual_df
             )
             
             if errors:
                 for error in errors:
                     st.error(error)
             else:
-                # 保存原始数据用于后续分析
+                # 保存原始数据用于后续分析（城市名称已在处理时清理）
                 st.session_state.plan_df = plan_df
                 st.session_state.actual_df = actual_df
+                st.session_state.actual_sorted = True
+                st.session_state.cities_normalized = True
+                st.session_state.province_cities = build_province_cities(plan_df)
+                st.session_state.plan_provinces, st.session_state.plan_all_cities = build_plan_regions(plan_df)
                 
                 # 设置默认筛选（选中第一个省份）
-                if '省份' in plan_df.columns:
-                    provinces = plan_df['省份'].dropna().unique()
-                    if len(provinces) > 0:
-                        st.session_state.selected_provinces = [provinces[0]]
+                provinces = st.session_state.plan_provinces
+                if not provinces.empty:
+                    st.session_state.selected_provinces = [provinces[0]]
                 
                 st.session_state.selected_cities = []
                 st.session_state.filter_applied = True
@@ -645,10 +865,15 @@ def render_data_import_page():
                 # 分析数据
                 result = analyze_data_by_region(
                     plan_df, actual_df,
-                    st.session_state.selected_provinces,
-                    st.session_state.selected_cities
+                    tuple(st.session_state.selected_provinces),
+                    tuple(st.session_state.selected_cities)
                 )
                 st.session_state.analysis_result = result
+                st.session_state.analysis_signature = (
+                    tuple(st.session_state.selected_provinces),
+                    tuple(st.session_state.selected_cities),
+                    id(plan_df), id(actual_df)
+                )
                 
                 # 保存到历史记录
                 save_to_history(result)
@@ -680,15 +905,21 @@ def render_completion_analysis_page():
     if plan_df is None or actual_df is None:
         return
     
-    # 清理城市名称（确保一致）
-    if '城市' in plan_df.columns:
-        plan_df.loc[:, '城市'] = plan_df['城市'].str.replace('市$', '', regex=True)
-    if '城市' in actual_df.columns:
-        actual_df.loc[:, '城市'] = actual_df['城市'].str.replace('市$', '', regex=True)
+    # 清理城市名称（确保一致，每次上传后只清理一次）
+    if not st.session_state.cities_normalized:
+        if '城市' in plan_df.columns:
+            plan_df['城市'] = strip_city_suffix(plan_df['城市'])
+        if '城市' in actual_df.columns:
+            actual_df['城市'] = strip_city_suffix(actual_df['城市'])
+        st.session_state.cities_normalized = True
     
-    # 获取省份和城市列表
-    provinces = list(plan_df['省份'].dropna().unique()) if '省份' in plan_df.columns else []
-    all_cities = list(plan_df['城市'].dropna().unique()) if '城市' in plan_df.columns else []
+    # 获取省份和城市列表（计划数据不变时直接复用）
+    if (st.session_state.province_cities is None or st.session_state.plan_provinces is None
+            or st.session_state.plan_all_cities is None):
+        st.session_state.province_cities = build_province_cities(plan_df)
+        st.session_state.plan_provinces, st.session_state.plan_all_cities = build_plan_regions(plan_df)
+    provinces = st.session_state.plan_provinces
+    all_cities = st.session_state.plan_all_cities
     
     # ============================================================================
     # 区域筛选
@@ -702,13 +933,14 @@ def render_completion_analysis_page():
     
     with col1:
         # 省份多选框
-        if provinces:
-            default_index = 0 if not st.session_state.selected_provinces else \
-                           provinces.index(st.session_state.selected_provinces[0]) if st.session_state.selected_provinces and st.session_state.selected_provinces[0] in provinces else 0
+        if not provinces.empty:
+            # 默认选中之前筛选的第一个省份（哈希查找），否则选中第一个省份
+            previous = st.session_state.selected_provinces
+            default_index = provinces.get_loc(previous[0]) if previous and previous[0] in provinces else 0
             selected_provinces = st.multiselect(
                 "选择省份",
                 options=provinces,
-                default=[provinces[default_index]] if provinces else [],
+                default=[provinces[default_index]],
                 key='province_multiselect'
             )
         else:
@@ -718,16 +950,18 @@ def render_completion_analysis_page():
     with col2:
         # 城市多选框
         # 如果选中了省份，只显示选中省份下的城市
-        if selected_provinces and len(selected_provinces) > 0:
-            cities_in_provinces = plan_df[plan_df['省份'].isin(selected_provinces)]['城市'].dropna().unique()
-            available_cities = list(cities_in_provinces)
+        if selected_provinces:
+            province_cities = st.session_state.province_cities
+            available_cities = list(dict.fromkeys(
+                city for province in selected_provinces for city in province_cities.get(province, [])
+            ))
         else:
             # 不选省份时，显示全部城市
             available_cities = all_cities
         
         if available_cities:
             # 如果之前有选中的城市，且在可用城市列表中，则保持选中
-            default_cities = [c for c in st.session_state.selected_cities if c in available_cities] if st.session_state.selected_cities else available_cities[:1] if available_cities else []
+            default_cities = [c for c in st.session_state.selected_cities if c in available_cities] if st.session_state.selected_cities else available_cities[:1]
             selected_cities = st.multiselect(
                 "选择城市",
                 options=available_cities,
@@ -747,9 +981,12 @@ def render_completion_analysis_page():
             st.session_state.selected_cities = selected_cities
             st.session_state.filter_applied = True
             
-            # 重新分析数据
-            result = analyze_data_by_region(plan_df, actual_df, selected_provinces, selected_cities)
-            st.session_state.analysis_result = result
+            # 重新分析数据（筛选条件和数据都未变化时沿用当前结果）
+            signature = (tuple(selected_provinces), tuple(selected_cities), id(plan_df), id(actual_df))
+            if signature != st.session_state.analysis_signature:
+                result = analyze_data_by_region(plan_df, actual_df, tuple(selected_provinces), tuple(selected_cities))
+                st.session_state.analysis_result = result
+                st.session_state.analysis_signature = signature
             
             st.success("✅ 筛选完成！")
     
@@ -839,13 +1076,9 @@ def render_completion_analysis_page():
         with col_export:
             if st.button("📥 导出区域统计", use_container_width=True):
                 # 导出到Excel
-                output = BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    region_stats.to_excel(writer, index=False, sheet_name='区域详情')
-                
                 st.download_button(
                     label="⬇️ 下载Excel文件",
-                    data=output.getvalue(),
+                    data=to_xlsx_bytes(region_stats, '区域详情'),
                     file_name=f"区域详情_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
@@ -937,26 +1170,28 @@ def render_checkin_validation_page():
             selected_cities = ['全部']
     
     # 筛选数据
-    filtered_df = actual_df.copy()
-    
-    # 时间筛选
+    # 时间筛选（开始分析后完工时间已排序，按时间范围直接切片）
+    is_sorted = st.session_state.actual_sorted
+    filtered_df = actual_df
     if time_mode == "日" and selected_date:
-        filtered_df.loc[:, '完工日期'] = pd.to_datetime(filtered_df['完工时间'], errors='coerce').dt.date
-        filtered_df = filtered_df[filtered_df['完工日期'] == selected_date]
+        start = pd.Timestamp(selected_date)
+        filtered_df = slice_by_completed_time(actual_df, start, start + pd.Timedelta(days=1), is_sorted)
     elif time_mode == "月" and selected_month_tuple:
         selected_year, selected_month = selected_month_tuple
-        filtered_df.loc[:, '完工年月'] = pd.to_datetime(filtered_df['完工时间'], errors='coerce')
-        filtered_df = filtered_df[
-            (filtered_df['完工年月'].dt.year == selected_year) & 
-            (filtered_df['完工年月'].dt.month == selected_month)
-        ]
+        start = pd.Timestamp(year=selected_year, month=selected_month, day=1)
+        filtered_df = slice_by_completed_time(actual_df, start, start + pd.offsets.MonthBegin(1), is_sorted)
     
-    # 区域筛选
+    # 区域筛选（先合并筛选条件，最后只取一次选中的行；未筛选时不复制数据）
+    mask = None
     if selected_provinces and '全部' not in selected_provinces:
-        filtered_df = filtered_df[filtered_df['省份'].isin(selected_provinces)]
+        mask = filtered_df['省份'].isin(selected_provinces)
     
     if selected_cities and '全部' not in selected_cities:
-        filtered_df = filtered_df[filtered_df['城市'].isin(selected_cities)]
+        city_mask = filtered_df['城市'].isin(selected_cities)
+        mask = city_mask if mask is None else mask & city_mask
+    
+    if mask is not None:
+        filtered_df = filtered_df.loc[mask]
     
     # 分析签到数据
     analysis = analyze_checkin(filtered_df)
@@ -1016,27 +1251,19 @@ def render_checkin_validation_page():
         if available_cols:
             display_df = invalid_df[available_cols].copy()
             
-            # 格式化时间列
-            time_cols = ['完工时间', '预约开始时间', '预约结束时间', '上门签到时间']
-            for col in time_cols:
-                if col in display_df.columns:
-                    # 检查是否是datetime类型
-                    if pd.api.types.is_datetime64_any_dtype(display_df[col]):
-                        display_df.loc[:, col] = display_df[col].dt.strftime('%Y-%m-%d %H:%M')
-                    else:
-                        # 如果不是datetime类型，尝试转换
-                        try:
-                            temp_dates = pd.to_datetime(display_df[col], errors='coerce')
-                            display_df.loc[:, col] = temp_dates.dt.strftime('%Y-%m-%d %H:%M')
-                        except:
-                            # 转换失败，保留原值
-                            pass
+            # 格式化时间列（所有时间列一次处理，已是datetime类型的列无需重新解析）
+            time_cols = [col for col in ['完工时间', '预约开始时间', '预约结束时间', '上门签到时间'] if col in display_df.columns]
+            display_df[time_cols] = display_df[time_cols].apply(
+                lambda col: pd.to_datetime(col, errors='coerce').dt.strftime('%Y-%m-%d %H:%M')
+            )
             
             # 合并省市作为区域
             if '省份' in display_df.columns and '城市' in display_df.columns:
-                display_df.loc[:, '区域'] = display_df['省份'] + ' - ' + display_df['城市']
+                # 转为object而不是str，省份或城市为空时区域保持为空（而不是显示"nan"）
+                display_df['区域'] = display_df['省份'].astype(object).str.cat(display_df['城市'].astype(object), sep=' - ')
+                display_df.drop(columns=['省份', '城市'], inplace=True)
                 # 调整列顺序
-                cols = ['区域'] + [col for col in display_df.columns if col not in ['区域', '省份', '城市']]
+                cols = ['区域'] + [col for col in display_df.columns if col != '区域']
                 display_df = display_df[cols]
             
             # 显示表格
@@ -1048,13 +1275,9 @@ def render_checkin_validation_page():
             
             # 导出功能
             if st.button("📥 导出无效记录", use_container_width=True):
-                output = BytesIO()
-                with pd.ExcelWriter(output, engine='openpyxl') as writer:
-                    display_df.to_excel(writer, index=False, sheet_name='无效签到记录')
-                
                 st.download_button(
                     label="⬇️ 下载Excel文件",
-                    data=output.getvalue(),
+                    data=to_xlsx_bytes(display_df, '无效签到记录'),
                     file_name=f"无效签到记录_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
                 )
@@ -1105,29 +1328,24 @@ def render_history_page():
                 key="history_month"
             )
     
-    # 获取过滤后的历史记录
-    filtered_history = st.session_state.history.copy()
+    # 获取过滤后的历史记录（取出筛选、排序所需的字段组成表格，按列筛选）
+    history = get_history()
+    history_df = pd.DataFrame({
+        'analysis_date': pd.Series([h.get('analysis_date', '') for h in history], dtype=object),
+        'untitled': pd.Series([h.get('custom_title') is None for h in history], dtype=bool)
+    })
     
     # 时间筛选
     if history_time_mode == "日" and history_selected_date:
-        filtered_history = [
-            h for h in filtered_history 
-            if 'analysis_date' in h and h['analysis_date'] == history_selected_date.strftime('%Y-%m-%d')
-        ]
+        history_df = history_df[history_df['analysis_date'] == history_selected_date.strftime('%Y-%m-%d')]
     elif history_time_mode == "月" and selected_month_tuple:
         selected_year, selected_month = selected_month_tuple
         month_str = f"{selected_year}-{selected_month:02d}"
-        filtered_history = [
-            h for h in filtered_history 
-            if 'analysis_date' in h and h['analysis_date'].startswith(month_str)
-        ]
+        history_df = history_df[history_df['analysis_date'].str.startswith(month_str, na=False)]
     
     # 排序：未设置标题的在前，然后按日期降序
-    filtered_history_sorted = sorted(
-        filtered_history,
-        key=lambda x: (x.get('custom_title') is None, x.get('analysis_date', '')),
-        reverse=True
-    )
+    history_df = history_df.sort_values(['untitled', 'analysis_date'], ascending=False, kind='stable')
+    filtered_history_sorted = [history[i] for i in history_df.index]
     
     # 显示记录数量
     st.markdown(f"**共{len(filtered_history_sorted)}条记录**")
@@ -1215,11 +1433,12 @@ def save_to_history(result):
         }
     }
     
-    # 添加到历史记录列表开头
-    st.session_state.history.insert(0, history_item)
+    # 添加到历史记录列表开头（尚未加载时无需加载，除非旧版本文件还未迁移）
+    if 'history' in st.session_state or not os.path.exists(HISTORY_FILE):
+        get_history().insert(0, history_item)
     
-    # 保存到文件
-    save_history()
+    # 追加到文件
+    append_history(history_item)
 
 # ============================================================================
 # 主程序